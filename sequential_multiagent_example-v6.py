@@ -5,7 +5,8 @@ import os
 import re
 import asyncio
 from dotenv import load_dotenv
-from openai import OpenAI
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
 
 from langchain_mcp_adapters.client import MultiServerMCPClient
 from langchain_mcp_adapters.tools import load_mcp_tools
@@ -26,6 +27,12 @@ if not os.getenv("TAVILY_API_KEY"):
 TAVILY_API_KEY = os.getenv("TAVILY_API_KEY")
 SERVER_PATH = "/Users/arun/Documents/RamSELabs/Corporate Training/Course Materials/ces_it/agents_demos/mcp-servers-ces/mcp-server-demo/main.py"
 
+# Moderation client settings (seconds / connection counts)
+MODERATION_TIMEOUT = float(os.getenv("MODERATION_TIMEOUT", "10"))
+MODERATION_CONNECT_TIMEOUT = float(os.getenv("MODERATION_CONNECT_TIMEOUT", "5"))
+MODERATION_MAX_CONNECTIONS = int(os.getenv("MODERATION_MAX_CONNECTIONS", "20"))
+MODERATION_KEEPALIVE_EXPIRY = float(os.getenv("MODERATION_KEEPALIVE_EXPIRY", "60"))
+
 
 # =============================================================================
 # GUARDRAILS IMPLEMENTATION
@@ -39,6 +46,56 @@ class GuardrailResult:
         self.issues = issues or []
 
 
+# PII detection rules, compiled once at import. Each rule is (group name,
+# pattern, replacement token, issue label). Order matters: rules are applied in
+# this order, each to the previous rule's output.
+PII_RULES = [
+    ("email", r'[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}', '[REDACTED_EMAIL]', "Emails detected"),
+    ("phone_us", r'\+?1?[-.\s]?\(?\d{3}\)?[-.\s]?\d{3}[-.\s]?\d{4}', '[REDACTED_PHONE]', "Phone numbers detected"),
+    ("phone_intl", r'\+\d{1,3}[-.\s]?\d{1,4}[-.\s]?\d{1,4}[-.\s]?\d{1,9}', '[REDACTED_PHONE]', "Phone numbers detected"),
+    ("ssn", r'\b\d{3}[-.\s]?\d{2}[-.\s]?\d{4}\b', '[REDACTED_SSN]', "SSN-like patterns detected"),
+    ("cc", r'\b(?:\d{4}[-.\s]?){3}\d{4}\b', '[REDACTED_CC]', "Credit card-like patterns detected"),
+    ("ip", r'\b(?:\d{1,3}\.){3}\d{1,3}\b', '[REDACTED_IP]', "IP addresses detected"),
+]
+
+PII_REGEX = re.compile("|".join(f"(?P<{name}>{pattern})" for name, pattern, _, _ in PII_RULES))
+PII_REPLACEMENTS = {name: replacement for name, _, replacement, _ in PII_RULES}
+PII_PATTERNS = [(name, re.compile(pattern)) for name, pattern, _, _ in PII_RULES]
+
+
+def scan_and_redact_pii(text: str):
+    """
+    Redact all PII in the text.
+    
+    Rules run one after another on the previous rule's output, exactly like
+    separate findall + sub passes, so a later rule still sees digits left
+    next to an earlier replacement token. Text without any PII (the common
+    case) costs a single scan of the combined PII_REGEX.
+    
+    Args:
+        text: Text to scan
+    
+    Returns:
+        Tuple of (redacted_text, issues) where issues uses the same
+        "<label>: <count>" format as GuardrailResult.issues
+    """
+    if PII_REGEX.search(text) is None:
+        return text, []
+    
+    counts = {}
+    for name, pattern in PII_PATTERNS:
+        text, found = pattern.subn(PII_REPLACEMENTS[name], text)
+        if found:
+            counts[name] = found
+    
+    issues = [
+        f"{label}: {counts[name]}"
+        for name, _, _, label in PII_RULES
+        if name in counts
+    ]
+    return text, issues
+
+
 def redact_pii(text: str) -> GuardrailResult:
     """
     PII Redaction Guardrail - Detects and redacts personally identifiable information.
@@ -53,47 +110,7 @@ def redact_pii(text: str) -> GuardrailResult:
     """
     print("🛡️  GUARDRAIL: Scanning for PII (Personally Identifiable Information)...")
     
-    issues = []
-    redacted_text = text
-    
-    # Email addresses
-    email_pattern = r'[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}'
-    emails_found = re.findall(email_pattern, redacted_text)
-    if emails_found:
-        issues.append(f"Emails detected: {len(emails_found)}")
-        redacted_text = re.sub(email_pattern, '[REDACTED_EMAIL]', redacted_text)
-    
-    # Phone numbers (various formats)
-    phone_patterns = [
-        r'\+?1?[-.\s]?\(?\d{3}\)?[-.\s]?\d{3}[-.\s]?\d{4}',  # US format
-        r'\+\d{1,3}[-.\s]?\d{1,4}[-.\s]?\d{1,4}[-.\s]?\d{1,9}',  # International
-    ]
-    for pattern in phone_patterns:
-        phones_found = re.findall(pattern, redacted_text)
-        if phones_found:
-            issues.append(f"Phone numbers detected: {len(phones_found)}")
-            redacted_text = re.sub(pattern, '[REDACTED_PHONE]', redacted_text)
-    
-    # Social Security Numbers
-    ssn_pattern = r'\b\d{3}[-.\s]?\d{2}[-.\s]?\d{4}\b'
-    ssns_found = re.findall(ssn_pattern, redacted_text)
-    if ssns_found:
-        issues.append(f"SSN-like patterns detected: {len(ssns_found)}")
-        redacted_text = re.sub(ssn_pattern, '[REDACTED_SSN]', redacted_text)
-    
-    # Credit card numbers (basic patterns)
-    cc_pattern = r'\b(?:\d{4}[-.\s]?){3}\d{4}\b'
-    ccs_found = re.findall(cc_pattern, redacted_text)
-    if ccs_found:
-        issues.append(f"Credit card-like patterns detected: {len(ccs_found)}")
-        redacted_text = re.sub(cc_pattern, '[REDACTED_CC]', redacted_text)
-    
-    # IP addresses
-    ip_pattern = r'\b(?:\d{1,3}\.){3}\d{1,3}\b'
-    ips_found = re.findall(ip_pattern, redacted_text)
-    if ips_found:
-        issues.append(f"IP addresses detected: {len(ips_found)}")
-        redacted_text = re.sub(ip_pattern, '[REDACTED_IP]', redacted_text)
+    redacted_text, issues = scan_and_redact_pii(text)
     
     if issues:
         print(f"   ⚠️  PII Detected and Redacted: {', '.join(issues)}")
@@ -107,6 +124,44 @@ def redact_pii(text: str) -> GuardrailResult:
     )
 
 
+# Shared moderation client. Created lazily on first use so every guardrail
+# pass reuses the same keep-alive connection pool instead of opening a new one.
+_moderation_client = None
+_moderation_client_loop = None
+
+
+def get_moderation_client() -> AsyncOpenAI:
+    """Return the shared AsyncOpenAI client used for moderation calls."""
+    global _moderation_client, _moderation_client_loop
+    
+    loop = asyncio.get_running_loop()
+    # httpx connection pools are bound to the event loop that created them
+    if _moderation_client is None or _moderation_client_loop is not loop:
+        _moderation_client = AsyncOpenAI(
+            timeout=httpx.Timeout(MODERATION_TIMEOUT, connect=MODERATION_CONNECT_TIMEOUT),
+            http_client=DefaultAsyncHttpxClient(
+                limits=httpx.Limits(
+                    max_connections=MODERATION_MAX_CONNECTIONS,
+                    max_keepalive_connections=MODERATION_MAX_CONNECTIONS,
+                    keepalive_expiry=MODERATION_KEEPALIVE_EXPIRY,
+                ),
+            ),
+        )
+        _moderation_client_loop = loop
+    
+    return _moderation_client
+
+
+async def close_moderation_client():
+    """Close the shared moderation client and its connection pool."""
+    global _moderation_client, _moderation_client_loop
+    
+    if _moderation_client is not None:
+        await _moderation_client.close()
+        _moderation_client = None
+        _moderation_client_loop = None
+
+
 async def detect_harmful_content(text: str) -> GuardrailResult:
     """
     Harmful Content Detection Guardrail - Uses OpenAI's moderation API.
@@ -122,10 +177,10 @@ async def detect_harmful_content(text: str) -> GuardrailResult:
     print("🛡️  GUARDRAIL: Checking for harmful content...")
     
     try:
-        client = OpenAI()
+        client = get_moderation_client()
         
         # Use OpenAI's moderation endpoint
-        response = client.moderations.create(input=text)
+        response = await client.moderations.create(input=text)
         
         result = response.results[0]
         
@@ -207,7 +262,30 @@ async def apply_output_guardrails(text: str, stage: str = "Output") -> Guardrail
 # PIPELINE FUNCTIONS
 # =============================================================================
 
-async def run_research_pipeline(writer_agent, editor_agent, topic: str):
+async def refine_with_editor(editor_agent, written_content: str) -> str:
+    """Run the Editor Agent on a draft and return the refined article."""
+    editor_result = await editor_agent.ainvoke(
+        {
+            "messages": [
+                HumanMessage(
+                    content=(
+                        "Please refine and enhance the following article:\n\n"
+                        f"{written_content}\n\n"
+                        "Focus on:\n"
+                        "- Clarity and flow\n"
+                        "- Grammar and style\n"
+                        "- Structure and readability\n"
+                        "- Fact consistency and accuracy"
+                    )
+                )
+            ]
+        }
+    )
+
+    return editor_result["messages"][-1].content
+
+
+async def run_research_pipeline(writer_agent, editor_agent, topic: str, speculative_editor: bool = False):
     """
     Pipeline with Guardrails:
     1. Input Guardrail: Check Topic for Harmful Content & Redact PII.
@@ -215,6 +293,9 @@ async def run_research_pipeline(writer_agent, editor_agent, topic: str):
     3. Output Guardrail (Writer): Scan Writer output for PII/Harmful
     4. Editor Agent refines
     5. Output Guardrail (Editor): Final Scan
+    
+    With speculative_editor=True the Editor Agent starts on the PII-redacted
+    draft while the writer-output moderation check is still in flight.
     """
     print(f"\n{'='*60}")
     print(f"📝 Raw Topic Input: {topic}")
@@ -252,6 +333,12 @@ async def run_research_pipeline(writer_agent, editor_agent, topic: str):
     written_content = writer_result["messages"][-1].content
 
     # --- INTERMEDIATE GUARDRAILS (Writer Output) ---
+    if speculative_editor:
+        # Start the editor on the locally redacted draft while moderation runs;
+        # it is cancelled below if moderation blocks the draft
+        speculative_draft, _ = scan_and_redact_pii(written_content)
+        editor_task = asyncio.create_task(refine_with_editor(editor_agent, speculative_draft))
+
     writer_guardrail_result = await apply_output_guardrails(written_content, "Writer Output")
     if not writer_guardrail_result.passed:
         written_content = writer_guardrail_result.text
@@ -263,25 +350,14 @@ async def run_research_pipeline(writer_agent, editor_agent, topic: str):
 
     print("✏️  Editor Agent refining content...\n")
 
-    editor_result = await editor_agent.ainvoke(
-        {
-            "messages": [
-                HumanMessage(
-                    content=(
-                        "Please refine and enhance the following article:\n\n"
-                        f"{written_content}\n\n"
-                        "Focus on:\n"
-                        "- Clarity and flow\n"
-                        "- Grammar and style\n"
-                        "- Structure and readability\n"
-                        "- Fact consistency and accuracy"
-                    )
-                )
-            ]
-        }
-    )
-
-    refined_content = editor_result["messages"][-1].content
+    if speculative_editor and writer_guardrail_result.passed:
+        # The speculative edit ran on exactly the text the guardrail approved
+        refined_content = await editor_task
+    else:
+        if speculative_editor:
+            # Draft was blocked - discard the speculative edit
+            editor_task.cancel()
+        refined_content = await refine_with_editor(editor_agent, written_content)
 
     # --- FINAL OUTPUT GUARDRAILS ---
     final_guardrail_result = await apply_output_guardrails(refined_content, "Final Output")
@@ -375,6 +451,9 @@ async def main():
         # Run the pipeline
         result = await run_research_pipeline(writer_agent, editor_agent, topic)
 
+        # Moderation is done once the pipeline returns
+        await close_moderation_client()
+
         # Handle error case
         if "error" in result:
             print(f"\n❌ Pipeline Error: {result['error']}")
@@ -3,7 +3,9 @@
 # This example is without guardrails for clarity.
 
 import os
+import time
 import asyncio
+from collections import OrderedDict
 from dotenv import load_dotenv
 
 from langchain_mcp_adapters.client import MultiServerMCPClient
@@ -27,6 +29,10 @@ if not os.getenv("MEM0_API_KEY"):
 TAVILY_API_KEY = os.getenv("TAVILY_API_KEY")
 SERVER_PATH = "/Users/arun/Documents/RamSELabs/Corporate Training/Course Materials/ces_it/agents_demos/mcp-servers-ces/mcp-server-demo/main.py"
 
+# Read-through cache for mem0 searches (invalidated per user on writes)
+MEMORY_CACHE_SIZE = int(os.getenv("MEMORY_CACHE_SIZE", "256"))
+MEMORY_CACHE_TTL = float(os.getenv("MEMORY_CACHE_TTL", "300"))
+
 # Initialize Mem0
 mem0_client = MemoryClient(api_key=os.getenv("MEM0_API_KEY"))
 
@@ -34,33 +40,113 @@ mem0_client = MemoryClient(api_key=os.getenv("MEM0_API_KEY"))
 # MEM0 HELPER FUNCTIONS
 # =============================================================================
 
+class MemorySearchCache:
+    """
+    Read-through LRU + TTL cache for mem0 searches, keyed by user and normalized query.
+    
+    Writes bump a per-user generation so in-flight searches can't cache stale results.
+    """
+    def __init__(self, max_entries: int = MEMORY_CACHE_SIZE, ttl_seconds: float = MEMORY_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._generations = {}
+
+    @staticmethod
+    def key(query: str, user_id: str, limit: int) -> tuple:
+        return user_id, " ".join(query.lower().split()), limit
+
+    def generation(self, user_id: str) -> int:
+        return self._generations.get(user_id, 0)
+
+    def get(self, query: str, user_id: str, limit: int):
+        key = self.key(query, user_id, limit)
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, memories = entry
+            if expires_at > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return memories
+            del self._entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, query: str, user_id: str, limit: int, memories: list, generation: int):
+        if generation != self.generation(user_id):
+            return
+        key = self.key(query, user_id, limit)
+        self._entries[key] = (time.monotonic() + self.ttl, memories)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate_user(self, user_id: str):
+        self._generations[user_id] = self.generation(user_id) + 1
+        for key in [key for key in self._entries if key[0] == user_id]:
+            del self._entries[key]
+
+memory_search_cache = MemorySearchCache()
+
+def _search_memories(query: str, user_id: str, limit: int) -> list:
+    """Run a mem0 v2 search and return the raw list of memories."""
+    filters = {
+        "AND": [
+            {"user_id": user_id}
+        ]
+    }
+    
+    search_results = mem0_client.search(
+        query=query,
+        version="v2",
+        filters=filters,
+        limit=limit
+    )
+    
+    if search_results and 'results' in search_results:
+        return search_results['results'] or []
+    return []
+
+def _format_memories(memories: list) -> str:
+    if memories:
+        formatted = '\n'.join([f"{i+1}. {m.get('memory', '')}" for i, m in enumerate(memories)])
+        print(f"   ✅ Found {len(memories)} relevant memories\n")
+        return formatted
+    
+    print("   ℹ️  No previous memories found\n")
+    return ""
+
 def retrieve_memories(query: str, user_id: str, limit: int = 5) -> str:
     """Retrieve relevant memories from mem0."""
     try:
         print(f"🧠 Retrieving memories for user: {user_id}...")
         
-        filters = {
-            "AND": [
-                {"user_id": user_id}
-            ]
-        }
-        
-        search_results = mem0_client.search(
-            query=query,
-            version="v2",
-            filters=filters,
-            limit=limit
-        )
+        memories = memory_search_cache.get(query, user_id, limit)
+        if memories is None:
+            generation = memory_search_cache.generation(user_id)
+            memories = _search_memories(query, user_id, limit)
+            memory_search_cache.put(query, user_id, limit, memories, generation)
         
-        if search_results and 'results' in search_results:
-            memories = search_results['results']
-            if memories:
-                formatted = '\n'.join([f"{i+1}. {m.get('memory', '')}" for i, m in enumerate(memories)])
-                print(f"   ✅ Found {len(memories)} relevant memories\n")
-                return formatted
+        return _format_memories(memories)
         
-        print("   ℹ️  No previous memories found\n")
+    except Exception as e:
+        print(f"   ⚠️  Memory retrieval error: {e}\n")
         return ""
+
+async def retrieve_memories_async(query: str, user_id: str, limit: int = 5) -> str:
+    """Retrieve relevant memories without blocking the event loop (search runs in a thread)."""
+    try:
+        print(f"🧠 Retrieving memories for user: {user_id}...")
+        
+        memories = memory_search_cache.get(query, user_id, limit)
+        if memories is None:
+            generation = memory_search_cache.generation(user_id)
+            memories = await asyncio.to_thread(_search_memories, query, user_id, limit)
+            memory_search_cache.put(query, user_id, limit, memories, generation)
+        
+        return _format_memories(memories)
         
     except Exception as e:
         print(f"   ⚠️  Memory retrieval error: {e}\n")
@@ -76,6 +162,7 @@ def save_memory(user_id: str, messages: list, metadata: dict = None):
             user_id=user_id,
             metadata=metadata
         )
+        memory_search_cache.invalidate_user(user_id)
         
         if result and 'results' in result:
             print(f"   ✅ Saved {len(result['results'])} memories\n")
@@ -135,7 +222,7 @@ async def run_research_pipeline(writer_agent, editor_agent, topic: str, user_id:
     print(f"{'='*60}\n")
 
     # Retrieve memories
-    past_context = retrieve_memories(query=topic, user_id=user_id, limit=5)
+    past_context = await retrieve_memories_async(query=topic, user_id=user_id, limit=5)
     
     # Build writer prompt with memory context
     memory_section = f"""